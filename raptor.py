@@ -7,6 +7,7 @@
 # sub-blocks are made from EACH block, such that they can be decoded in working memory. N >= 1 subblocks.
 # sublocks have K sub-symbols, of size T'.
 
+import math
 import numpy
 import random
 import sys
@@ -21,15 +22,128 @@ Kmin = 1024
 # target size for sub-block, in bytes. let's say 1kb
 W = 1024
 
+# GF(256) arithmetic, as used by RaptorQ (RFC 6330 section 5.7). elements are
+# bytes, addition is xor, and multiplication is done with log/exp tables for
+# the primitive polynomial x^8 + x^4 + x^3 + x^2 + 1. GF(2) is a subfield, so
+# binary rows and symbols can be mixed freely with GF(256) ones.
+GF256_POLY = 0x11d
+
+def _gf256_tables():
+    exp = numpy.zeros(510, numpy.uint8)
+    log = numpy.zeros(256, int)
+    x = 1
+    for i in range(255):
+        exp[i] = x
+        log[x] = i
+        x <<= 1
+        if x & 0x100:
+            x ^= GF256_POLY
+    # repeat the exp table so that exp[log(a) + log(b)] never needs a mod 255
+    exp[255:510] = exp[0:255]
+    # full 256 x 256 multiplication table, so that multiplying a whole row of
+    # symbols by a scalar is a single (vectorized) lookup: mul[beta][row]
+    mul = exp[log[:,None] + log[None,:]]
+    mul[0,:] = 0
+    mul[:,0] = 0
+    return exp, log, mul
+
+GF256_EXP, GF256_LOG, GF256_MUL = _gf256_tables()
+
+def gf256_mul(a, b):
+    # elementwise product of a and b (scalars or arrays, numpy broadcasting
+    # rules apply)
+    return GF256_MUL[numpy.asarray(a, numpy.uint8), numpy.asarray(b, numpy.uint8)]
+
+def gf256_inv(a):
+    assert a != 0
+    return GF256_EXP[255 - GF256_LOG[a]]
+
+def gf256_addmul(dst, src, beta):
+    # dst = dst + beta*src, in place. this is the basic row operation for
+    # gaussian elimination over GF(256). dst can also be a matrix with one
+    # beta per row, in which case beta[r]*src is added to every row r with a
+    # single table lookup.
+    src = numpy.asarray(src, numpy.uint8)
+    beta = numpy.asarray(beta, numpy.uint8)
+    if beta.ndim:
+        dst ^= GF256_MUL[beta[:,None], src[None,:]]
+    elif beta == 1:
+        dst ^= src
+    elif beta != 0:
+        dst ^= GF256_MUL[beta][src]
+    return dst
+
+def gf256_selfcheck():
+    # check the table driven kernels against a plain shift-and-add multiply,
+    # for scalar multipliers 0, 1 and others and for a vector of per-row
+    # multipliers. src is int, as the rows of build_constraint_matrix() are.
+    def slow_mul(a, b):
+        r = 0
+        while b:
+            if b & 1:
+                r ^= a
+            b >>= 1
+            a <<= 1
+            if a & 0x100:
+                a ^= GF256_POLY
+        return r
+    src = numpy.arange(0, 256, 7)
+    for a in range(256):
+        assert numpy.all(gf256_mul(a, src) == [slow_mul(a, int(s)) for s in src])
+        if a:
+            assert gf256_mul(a, gf256_inv(a)) == 1
+    for beta in [0, 1, 2, 0x53, 255]:
+        dst = numpy.arange(len(src), dtype=numpy.uint8)
+        expected = dst ^ gf256_mul(beta, src)
+        assert numpy.all(gf256_addmul(dst, src, beta) == expected)
+    betas = numpy.array([0, 1, 2, 0x53, 255])
+    dst = numpy.zeros((len(betas), len(src)), numpy.uint8)
+    gf256_addmul(dst, src, betas)
+    assert numpy.all(dst == gf256_mul(betas[:,None], src[None,:]))
+    print("GF(256) kernels ok")
+
+
+
+def pack_hdpc_words(Gh):
+    # pack each row of a binary Gh into a single word, one bit per entry, so
+    # that all h hdpc symbols can be updated with one xor per intermediate
+    # symbol. rows wider than a machine word fall back to python ints.
+    rows, h = Gh.shape
+    if h < 63:
+        return Gh.astype(numpy.int64).dot(numpy.int64(1) << numpy.arange(h)).tolist()
+    shifts = numpy.array([1 << j for j in range(h)], object)
+    return (Gh.astype(object)*shifts).sum(axis=1).tolist()
+
+
+def build_constraint_matrix(K, G=None, Gh=None):
+    # build the full constraint matrix over all K + c + h intermediate
+    # symbols. each column is one constraint: the xor of the symbols with
+    # a 1 in that column is 0. the ldpc constraints cover the source
+    # symbols plus their own redundant symbol, the hdpc constraints cover
+    # the source and ldpc symbols plus their own redundant symbol.
+    c = G.shape[1] if G is not None else 0
+    h = Gh.shape[1] if Gh is not None else 0
+    total_symbols = K + c + h
+    M = numpy.zeros((total_symbols, c + h), int)
+    if c:
+        M[0:K, 0:c] = G
+        M[K:K+c, 0:c] = numpy.identity(c, int)
+    if h:
+        M[0:K+c, c:c+h] = Gh
+        M[K+c:total_symbols, c:c+h] = numpy.identity(h, int)
+    return M
 
 
 # one raptor manager is used per object
 class RaptorManager:
-    def __init__(self, filename, K=1024, debug=True):
+    def __init__(self, filename, K=1024, debug=True, symb_size=None):
         self.debug = debug
         self.f = open(filename, 'rb')
         # number of symbols in each source block
         self.K = int(K)
+        # size of each symbol in bytes, for GF(256) codes. if None, symbols
+        # are single bits.
+        self.symb_size = symb_size
         # keep a counter of how many blocks get sent out.
         self.current_block = 0
         # remember how much padding the last block used
@@ -37,6 +151,10 @@ class RaptorManager:
         self.last_block = False
         # constraint matrix for codes that use pre-coding.
         self.G = None
+        # second stage (HDPC/hamming) constraint matrix, over the source plus
+        # LDPC symbols, and its rows packed into words for the encoder.
+        self.Gh = None
+        self.hdpc_words = None
         if self.debug:
             print("registered " +self.f.name+ ".")
 
@@ -109,28 +227,132 @@ class RaptorManager:
     def get_constraint_matrix(self):
         return self.G
 
+    def generate_hdpc_matrix(self, gf256=False):
+        # second stage of the R10 precode (RFC 5053 section 5.4.2.3): h dense
+        # "half" constraints over the K source symbols and the c LDPC symbols.
+        # h is the smallest value such that choose(h, ceil(h/2)) >= K + c,
+        # and each of the K + c symbols is assigned a distinct h-bit gray code
+        # value with exactly ceil(h/2) bits set. bit j of a symbol's gray value
+        # says whether that symbol takes part in the j'th hdpc constraint.
+        if self.G is not None:
+            c = self.G.shape[1]
+        else:
+            c = 0
+        L = self.K + c
+        h = 1
+        while self._choose(h, int(math.ceil(h/2.0))) < L:
+            h += 1
+        h_prime = int(math.ceil(h/2.0))
+
+        if gf256:
+            Gh = self._gf256_hdpc_matrix(L, h)
+            print("Gh matrix (GF(256)):")
+            print(Gh)
+            self.Gh = Gh
+            return Gh
+
+        Gh = numpy.zeros((L, h), int)
+        i = 0
+        j = 0
+        while j < L:
+            # i'th value of the gray sequence. we only use the ones with the
+            # right weight.
+            g = i ^ (i >> 1)
+            if bin(g).count('1') == h_prime:
+                for bit in range(h):
+                    Gh[j, bit] = (g >> bit) & 1
+                j += 1
+            i += 1
+
+        print("Gh matrix:")
+        print(Gh)
+        self.Gh = Gh
+        # the packed words don't depend on the block, so build them once here
+        # rather than in every encoder.
+        self.hdpc_words = pack_hdpc_words(Gh)
+        return Gh
+
+    def get_hdpc_matrix(self):
+        return self.Gh
+
+    def get_hdpc_words(self):
+        return self.hdpc_words
+
+    def _gf256_hdpc_matrix(self, L, h):
+        # RaptorQ style hdpc rows (RFC 6330 section 5.3.3.3): HDPC = MT*GAMMA,
+        # where MT is h x L with two random ones per column except for the last
+        # column which is alpha^i, and GAMMA[i,j] = alpha^(i-j) for i >= j. we
+        # use python's random in place of the RFC's Rand() tables, like
+        # generate_constraint_matrix() does.
+        MT = numpy.zeros((h, L), numpy.uint8)
+        for j in range(L-1):
+            i1 = random.randrange(h)
+            MT[i1, j] = 1
+            if h > 1:
+                i2 = (i1 + random.randrange(h-1) + 1) % h
+                MT[i2, j] = 1
+        MT[:, L-1] = GF256_EXP[0:h]
+        # multiplying by the lower triangular GAMMA is the recurrence
+        # r[j] = MT[j] + alpha*r[j+1], one vectorized step per column.
+        HDPC = MT.copy()
+        for j in range(L-2, -1, -1):
+            HDPC[:, j] ^= gf256_mul(HDPC[:, j+1], GF256_EXP[1])
+        # same orientation as G: one column per constraint.
+        return HDPC.T.astype(int)
+
+    def _choose(self, n, k):
+        return math.factorial(n) // (math.factorial(k) * math.factorial(n-k))
+
     def num_bits(self, block):
         # block is a bitarray object, which packs bits into longs. so number of
         # bits is the size in bytes * 8.
         info = block.buffer_info()
         return info[1]*8
 
+    def _encode_symbol_block(self):
+        # read K symbols of symb_size bytes each, as a K x symb_size array of
+        # GF(256) elements. the last block is padded with zero bytes.
+        n = self.K*self.symb_size
+        data = self.f.read(n)
+        if len(data) < n:
+            self.last_block = True
+            self.padding_last = n - len(data)
+            if not data:
+                return None
+            data = data + b'\0'*(n - len(data))
+        return numpy.frombuffer(data, numpy.uint8).reshape(self.K, self.symb_size).copy()
+
     def next_block(self):
         # keep track of where we are and return the next block
         if self.last_block:
             return None
-        the_block = self._encode_binary_block()
+        if self.symb_size:
+            the_block = self._encode_symbol_block()
+        else:
+            the_block = self._encode_binary_block()
         self.current_block += 1
         return the_block
 
 class RaptorEncoder:
-    def __init__(self, block, G=None, symb_size=1, debug=True):
+    def __init__(self, block, G=None, symb_size=1, debug=True, Gh=None, gf256=False, hdpc_words=None):
         # precode and distribution are each function variables
         self.debug = debug
-        # symbols is a bitarray()
-        self.symbols = block
+        # whether this is a GF(256) code. if so every symbol (source,
+        # intermediate and encoded) is a row of symb_size bytes, and Gh may
+        # have GF(256) entries.
+        self.gf256 = gf256
+        self.symb_size = symb_size
+        # symbols is a bitarray(), or a K x symb_size array of bytes
+        if self.gf256:
+            self.symbols = numpy.asarray(block, numpy.uint8).reshape(-1, symb_size)
+        else:
+            self.symbols = block
         # generator matrix for pre-code, if any
         self.G = G
+        # generator matrix for the second (hdpc) pre-code stage, if any
+        self.Gh = Gh
+        # rows of Gh packed by pack_hdpc_words(). built from Gh if not given.
+        self.hdpc_words = hdpc_words
         # precoded is a bitarray()
         self.intermediate = None
 
@@ -138,8 +360,20 @@ class RaptorEncoder:
         # constraint matrix self.G must exist and be passed in as an
         # initialization argument to the encoder.
 
-        # convert symbols to a numpy array for matrix multiplication
         G_rows, G_cols = self.G.shape
+        if self.gf256:
+            # z_i is the xor of the source symbol rows with a 1 in column i of
+            # G. accumulate them one source symbol at a time, with the row of
+            # G as the multipliers for all c redundant symbols at once.
+            self.z = numpy.zeros((G_cols, self.symb_size), numpy.uint8)
+            for i in range(G_rows):
+                gf256_addmul(self.z, self.symbols[i], self.G[i,:])
+            self.intermediate = numpy.vstack((self.symbols, self.z))
+            print("all intermediate symbols:")
+            print(self.intermediate)
+            return self.intermediate
+
+        # convert symbols to a numpy array for matrix multiplication
         k = numpy.array(self.symbols.tolist())
         print("precoding with generator matrix...")
         print(self.G)
@@ -171,6 +405,49 @@ class RaptorEncoder:
         assert len(self.intermediate) == G_cols+len(k)
         return self.intermediate
 
+    def hdpc_precode(self):
+        # second pre-code stage. self.Gh must exist, and if there is an ldpc
+        # stage, ldpc_precode() must already have been called since the hdpc
+        # symbols cover the ldpc symbols too.
+        if self.intermediate is not None:
+            symbols = self.intermediate
+        else:
+            symbols = self.symbols
+        Gh_rows, Gh_cols = self.Gh.shape
+        assert len(symbols) == Gh_rows
+
+        if self.gf256:
+            # each hdpc symbol is the GF(256) sum of Gh[i,j]*symbol_i. add
+            # every symbol row into all h hdpc symbols at once, with the row
+            # of Gh as the multipliers.
+            self.h = numpy.zeros((Gh_cols, self.symb_size), numpy.uint8)
+            for i in range(Gh_rows):
+                gf256_addmul(self.h, symbols[i], self.Gh[i,:])
+            self.intermediate = numpy.vstack((symbols, self.h))
+            print("all intermediate symbols (with hdpc):")
+            print(self.intermediate)
+            return self.intermediate
+
+        # each row of Gh (ie the gray value of that symbol) is packed into a
+        # single word, so that all h constraints are updated with one xor per
+        # source symbol instead of one xor per (symbol, constraint) pair.
+        words = self.hdpc_words
+        if words is None:
+            words = pack_hdpc_words(self.Gh)
+        acc = 0
+        for i, bit in enumerate(symbols):
+            if bit:
+                acc ^= words[i]
+
+        # as with the ldpc symbols, each hdpc symbol has the same value as the
+        # xor of the other terms in its constraint.
+        self.h = bitarray([(acc >> j) & 1 for j in range(Gh_cols)])
+        self.intermediate = symbols + self.h
+        print("all intermediate symbols (with hdpc):")
+        print(self.intermediate)
+        assert len(self.intermediate) == Gh_rows + Gh_cols
+        return self.intermediate
+
     def distribution_random_LT(self, num_symbols):
         # return a vector of coefficient indices sampled from the contained
         # distribution. example return value: [17,22,238]
@@ -184,7 +461,7 @@ class RaptorEncoder:
         return v
 
     def generate_encoded(self):
-        if self.intermediate:
+        if self.intermediate is not None:
             symbols = self.intermediate
         else:
             symbols = self.symbols
@@ -196,17 +473,22 @@ class RaptorEncoder:
         v = self.distribution_random_LT(len(symbols))
         v.sort()
 
+        if self.gf256:
+            # xor the selected symbol rows together, a whole row at a time.
+            xorval = numpy.bitwise_xor.reduce(symbols[v], axis=0)
+            bits = 8*self.symb_size
+            return {'val': xorval, 'coefficients': v, 'bits': bits}
+
         # grab the symbols at the index positions that have a 1 in the
         # coefficient vector.
         selected_symbols = [symbols[idx] for idx in v]
 
-        # get the first two values to start the xor process (note this actually
-        # removes the values from selected_symbols, so after the for loop below
-        # selected_symbols will be in a wierd state and should not be used.
+        # sum([a,b,c...]) % 2 is equivalent to a^b^c^...
         xorval = sum(selected_symbols) % 2
+        bits = 1
 
         # return the xor'ed value and the associated coefficients
-        return {'val': xorval, 'coefficients': v}
+        return {'val': xorval, 'coefficients': v, 'bits': bits}
 
 class RaptorGaussDecoder:
 
@@ -319,7 +601,7 @@ class RaptorGaussDecoder:
         print(self.A.shape)
         mat = numpy.hstack((self.A,b.T))
         tri, b = self._triangularize(mat)
-        if tri == None:
+        if tri is None:
             return None
         return self._backsub(tri, b)
 
@@ -391,6 +673,44 @@ class RaptorGaussDecoder:
         return mat[:, 0:cols], mat[:, -1]
 
 
+    def decode_gauss_gf256(self):
+        # same as decode_gauss_base2(), but A may contain GF(256) coefficients
+        # and b GF(256) values. b can also have one row of symb_size bytes
+        # per equation. uses gauss-jordan elimination so no back substitution
+        # is needed.
+        b = numpy.asarray(self.b)
+        single = b.ndim == 1
+        if single:
+            b = b[:,None]
+        mat = numpy.hstack((self.A,b)).astype(numpy.uint8)
+        rows = mat.shape[0]
+        cols = self.A.shape[1]
+        for c in range(0, cols):
+            col_vals = mat[c:rows,c]
+            if col_vals.max() == 0:
+                print("error: all zeros below row/column (%d, %d). multiple solutions." % (c,c))
+                return None
+            max_i = col_vals.nonzero()[0][0]
+            if not (max_i+c) == c:
+                upper_row = mat[c,:].copy()
+                mat[c,:] = mat[c+max_i,:]
+                mat[c+max_i,:] = upper_row
+
+            # scale the pivot row so it has a 1 on the diagonal.
+            mat[c,:] = gf256_mul(mat[c,:], gf256_inv(mat[c,c]))
+
+            # now zero out column c in every other row, with one batched
+            # multiply-add of the pivot row.
+            factors = mat[:,c].copy()
+            factors[c] = 0
+            gf256_addmul(mat, mat[c,:].copy(), factors)
+        # end column iteration
+
+        soln = mat[0:cols, cols:].astype(int)
+        if single:
+            return soln[:,0]
+        return soln
+
     def decode_gauss_base10(self):
         # attempt decode
         print("attempting solution...")
@@ -407,18 +727,76 @@ class RaptorGaussDecoder:
         return bits.tostring()
 
 
+class RaptorDecodeScheduler:
+
+    def __init__(self, K, first_attempt=None, step=1, factor=2, limit=None):
+        # decides when a decoder should try an expensive (dense) decode, using
+        # only cheap bookkeeping: how many symbols have been received, a lower
+        # bound on the rank deficit, and whether peeling is still releasing
+        # symbols. a failed attempt isn't fatal, the next one is just pushed
+        # back by a geometrically growing number of symbols.
+        self.K = K
+        # received count for the first attempt. nothing can be solved with
+        # fewer than K symbols.
+        if first_attempt is None:
+            first_attempt = K
+        self.next_attempt = first_attempt
+        # back-off (in symbols) after the next failure, and its growth factor
+        self.step = step
+        self.factor = factor
+        # received count after which to give up on the block entirely, if any
+        self.limit = limit
+        self.attempts = 0
+        self.failures = 0
+
+    def ready(self, received, deficit, progress=False):
+        # deficit is a lower bound on how far the system is from full rank (ie
+        # unknowns minus equations). if it's positive a dense solve can't
+        # succeed no matter what.
+        if deficit > 0:
+            return False
+        if received < self.next_attempt:
+            return False
+        # peeling is basically free, so if the last symbol still released
+        # more symbols give it until the end of the current back-off window.
+        if progress and received < self.next_attempt + self.step:
+            return False
+        self.attempts += 1
+        return True
+
+    def failed(self, received):
+        self.failures += 1
+        self.next_attempt = received + self.step
+        self.step = int(math.ceil(self.step*self.factor))
+
+    def give_up(self, received):
+        return self.limit is not None and received >= self.limit
+
+    def symbols_needed(self, received, deficit):
+        # estimate of how many more symbols the sender should send before a
+        # decode attempt can succeed: at least the rank deficit, and at least
+        # enough to reach the next scheduled attempt.
+        return max(deficit, self.next_attempt - received, 1)
+
+
 class RaptorBPDecoder:
 
-    def __init__(self, K, G=None, oh=None):
+    def __init__(self, K, G=None, oh=None, Gh=None, gf256=False, scheduler=None, symb_size=1):
         # actual data symbols per block
         self.K = K
         # constraint matrix
         self.G = G
-        # overhead after which to STOP receiving packets and decode using the
-        # precode
+        # second stage (hdpc) constraint matrix
+        self.Gh = Gh
+        # whether this is a GF(256) code, with symbols of symb_size bytes
+        self.gf256 = gf256
+        self.symb_size = symb_size
+        # overhead after which to first try to decode using the precode
         self.oh = oh
         # BP decoder bookkeeping
         self.blocks_processed = 0
+        # bits received on the wire
+        self.bits_received = 0
         # keep track of how many xor operations have been performed (does not
         # account for looping over lists since these could be optimized out in
         # a more legit implementation)
@@ -426,13 +804,52 @@ class RaptorBPDecoder:
         # the number of columns of G is the number of constraint symbols, which
         self.known_symbols = {}
         self.waiting_symbols = []
-        if self.G != None:
-            self.constraint_symbols = self.G.shape[1]
+        # how many symbols the last bp_decode() call released
+        self.last_released = 0
+        # the source symbols, once decoded
+        self.recovered = None
+        # how many constraints prime() fed in as (waiting) symbols
+        self.primed_constraints = 0
+        if self.G is not None:
+            self.ldpc_symbols = self.G.shape[1]
+        else:
+            self.ldpc_symbols = 0
+        if self.Gh is not None:
+            self.hdpc_symbols = self.Gh.shape[1]
+        else:
+            self.hdpc_symbols = 0
+        self.constraint_symbols = self.ldpc_symbols + self.hdpc_symbols
+        if self.constraint_symbols:
             print("self.constraint_symbols")
             print(self.constraint_symbols)
             #self.prime()
-        else:
-            self.constraint_symbols = 0
+        # decides when to attempt decode_precode(). with no scheduler, only BP
+        # is used.
+        if scheduler is None and self.oh:
+            scheduler = RaptorDecodeScheduler(K, first_attempt=self.oh,
+                    limit=max(self.oh, 3*(K + self.constraint_symbols)))
+        self.scheduler = scheduler
+
+    def rank_deficit(self):
+        # cheap lower bound on how many more (independent) equations are needed
+        # by decode_precode(): the unknown intermediate symbols minus the
+        # equations it would have to work with. constraints fed in by prime()
+        # are already counted among (or resolved out of) the waiting symbols.
+        unknowns = self.K + self.constraint_symbols - len(self.known_symbols)
+        constraints = self.constraint_symbols - self.primed_constraints
+        return unknowns - len(self.waiting_symbols) - constraints
+
+    def symbols_needed(self):
+        # estimate of how many more encoded symbols the sender should send for
+        # this block. 0 once it is decoded.
+        if self.recovered is not None:
+            return 0
+        if self.scheduler is None:
+            return max(self.rank_deficit(), 1)
+        return self.scheduler.symbols_needed(self.blocks_processed, self.rank_deficit())
+
+    def constraint_matrix(self):
+        return build_constraint_matrix(self.K, self.G, self.Gh)
 
     def prime(self):
         # "prime" the decoding pump by filling in the info we already know.
@@ -441,15 +858,27 @@ class RaptorBPDecoder:
 
         # we know that for the constraint symbols, there are redundant blocks
         # such that xor of coeffs*(x1,x2,...xn) = 0. we have those coeffs
-        # already, they are the values of the corresponding columns in G
+        # already, they are the values of the corresponding columns in the
+        # constraint matrix (ldpc columns first, then hdpc columns). GF(256)
+        # hdpc constraints can't be peeled, so like RaptorQ they are only used
+        # in decode_precode().
         print("in prime()")
-        constraint_symbols = self.G.shape[1]
-        print("there are %d constraint symbols" % constraint_symbols)
-        for i in range(constraint_symbols):
-            coeffs = self.G[:,i].nonzero()[0]
-            coeffs = numpy.append(coeffs, self.K+i)
+        M = self.constraint_matrix()
+        print("there are %d constraint symbols" % self.constraint_symbols)
+        if self.gf256:
+            binary_constraints = self.ldpc_symbols
+        else:
+            binary_constraints = self.constraint_symbols
+        self.primed_constraints = binary_constraints
+        for i in range(binary_constraints):
+            coeffs = M[:,i].nonzero()[0]
+            if self.gf256:
+                val = numpy.zeros(self.symb_size, numpy.uint8)
+            else:
+                val = 0
             zi = {'coefficients': coeffs.tolist(),
-                    'val': 0,
+                    'val': val,
+                    'bits': 0,
                     }
             print(zi)
             self.bp_decode(zi)
@@ -460,9 +889,12 @@ class RaptorBPDecoder:
 
     def bp_decode(self, block):
         self.blocks_processed += 1
-        val = bool(block['val'])
+        self.bits_received += block.get('bits', 1)
+        # values are bits, or bytes when they cover GF(256) hdpc symbols
+        val = block['val']
         coeffs = block['coefficients']
         resolved = []
+        known_before = len(self.known_symbols)
 
         # add the symbol either to the known list if it's of length one, or to
         # the waiting list otherwise. then process the known list against the
@@ -510,47 +942,60 @@ class RaptorBPDecoder:
         print("still waiting symbols")
         print(self.waiting_symbols)
 
-        if self.oh and self.blocks_processed == self.oh:
+        self.last_released = len(self.known_symbols) - known_before
+
+        # need the known symbols to be the original k, not (just) the
+        # constraint symbols.
+        recovered_originals = [k for k in self.known_symbols if k < self.K]
+        if len(recovered_originals) == self.K:
+            print(self.known_symbols)
+            # return symbols as a bitarray (or K x symb_size bytes)
+            if self.gf256:
+                self.recovered = numpy.array([self.known_symbols[k] for k in range(self.K)], numpy.uint8)
+            else:
+                self.recovered = bitarray([self.known_symbols[k] for k in range(self.K)])
+            return self.recovered
+
+        if self.scheduler is None:
+            return None
+
+        if self.scheduler.ready(self.blocks_processed, self.rank_deficit(), self.last_released > 0):
             # recovered_symbols is returned as a bitarray
-            recovered_originals= self.decode_precode()
-            "decode_precode() returned..."
+            recovered_originals = self.decode_precode()
+            print("decode_precode() returned...")
             print(recovered_originals)
             if(len(recovered_originals)) == self.K:
                 print("symbols recovered!")
                 print(recovered_originals)
+                self.recovered = recovered_originals
                 return recovered_originals
-            else:
-                print("did not recover all symbols")
-                return "failed"
+            print("did not recover all symbols, backing off")
+            self.scheduler.failed(self.blocks_processed)
 
-        else:
-            # need the known symbols to be the original k, not (just) the
-            # constraint symbols.
-            recovered_originals = [k for k in self.known_symbols if k in range(self.K)]
-            if len(recovered_originals) == self.K:
-                print(self.known_symbols)
-                # return symbols as a bitarray
-                return bitarray(self.known_symbols.values()[0:self.K])
-            else: return None
+        if self.scheduler.give_up(self.blocks_processed):
+            print("did not recover all symbols")
+            return "failed"
+        return None
 
     def decode_precode(self):
         # arrange the constraint matrix G and the current state of
         # known/waiting symbols into a matrix and solve using gaussian
         # elimination.
         missing = self.K - len(self.known_symbols)
-        # self.G is K x c. we'll tack around epsilon columns of waiting symbols
-        # onto the side of the matrix and hope it's rank is high enough to
-        # solve the system of equations.
-        G = self.G.copy()
-        # extend G with the zi symbols, derived to ensure the constraint
+        # the constraint matrix is (K+c+h) x (c+h). we'll tack around epsilon
+        # columns of waiting symbols onto the side of the matrix and hope it's
+        # rank is high enough to solve the system of equations. the redundant
+        # symbols are already included, derived to ensure the constraint
         # symbols, which are 0, hold.
-        extension = numpy.zeros((self.constraint_symbols, self.constraint_symbols), int)
-        numpy.fill_diagonal(extension, 1)
-        G = numpy.vstack((G, extension))
+        G = self.constraint_matrix()
         total_symbols = self.K + self.constraint_symbols
         print("creating matrix to solve precode")
-        # also need to construct b. careful to maintain order.
-        b = numpy.zeros(self.constraint_symbols, int)
+        # also need to construct b. careful to maintain order. with gf256,
+        # each entry of b is a row of symb_size bytes.
+        if self.gf256:
+            b = numpy.zeros((self.constraint_symbols, self.symb_size), int)
+        else:
+            b = numpy.zeros(self.constraint_symbols, int)
         for item in self.waiting_symbols:
             # create a new row vector and set it to one as indicated by the
             # coefficient vector
@@ -558,7 +1003,7 @@ class RaptorBPDecoder:
             for i in range(total_symbols):
                 if i in item['coeffs']:
                     new_row[i] = 1
-            b = numpy.append(b, item['xor_val'])
+            b = numpy.append(b, [item['xor_val']], axis=0)
             new_row = numpy.array([new_row])
             G = numpy.hstack((G, new_row.T))
 
@@ -566,35 +1011,140 @@ class RaptorBPDecoder:
         for k, v in self.known_symbols.items():
             new_row = numpy.zeros(total_symbols, int)
             new_row[k] = 1
-            b = numpy.append(b, v)
+            b = numpy.append(b, [v], axis=0)
             new_row = numpy.array([new_row])
             G = numpy.hstack((G, new_row.T))
 
-        b = numpy.array([b])
-        # stack G and b together-- note we need to take the transpose of G
-        # since the constraints were column vectors-- and solve [G b]
-        both = numpy.hstack((G.T,b.T))
-        rank = numpy.linalg.matrix_rank(both)
-        print("rank of the precode decoding matrix: %d" % rank)
-
+        # solve [G b]-- note we need to take the transpose of G since the
+        # constraints were column vectors. (no real-valued rank check here:
+        # it says nothing about solvability over GF(2)/GF(256), and the
+        # scheduler may call this many times per block.)
         gauss = RaptorGaussDecoder(self.K, debug=True)
         gauss.A = G.T
-        gauss.b = b[0]
-        soln = gauss.decode_gauss_base2()
+        gauss.b = b
+        if self.gf256:
+            soln = gauss.decode_gauss_gf256()
+        else:
+            soln = gauss.decode_gauss_base2()
         print("gauss returned")
         print(soln)
         if soln is not None:
-            return bitarray(soln.tolist())
+            # the solution covers all the intermediate symbols, the first K of
+            # which are the source symbols.
+            if self.gf256:
+                return soln[0:self.K].astype(numpy.uint8)
+            return bitarray(soln[0:self.K].tolist())
         else:
             return []
 
+class RaptorSoftDecoder:
+
+    def __init__(self, K, G=None, Gh=None, iterations=100, scale=0.75):
+        # soft decision (normalized min-sum) decoder for the binary precode
+        # parity checks, for when the intermediate symbols come over a noisy
+        # channel instead of an erasure channel. the python counterpart of the
+        # comm.LDPCDecoder setup in LDPCFuncsCluster.m. a GF(256) hdpc stage
+        # has no binary parity checks, so pass Gh only for the binary one.
+        self.K = K
+        # parity check matrix: one row per constraint, one column per
+        # intermediate symbol.
+        H = build_constraint_matrix(K, G, Gh).T
+        assert H.max() <= 1, "soft decoding needs binary parity checks (no GF(256) Gh)"
+        self.checks, self.N = H.shape
+        # maximum number of message passing iterations
+        self.iterations = iterations
+        # min-sum overestimates the check messages; scaling them back down
+        # (normalized min-sum) gets most of the way to sum-product.
+        self.scale = scale
+        # the graph as an edge list. nonzero() returns the edges sorted by
+        # check, so each check's edges are one contiguous run starting at
+        # check_starts, which lets the check updates use reduceat.
+        self.edge_check, self.edge_var = H.nonzero()
+        self.edges = len(self.edge_var)
+        self.check_starts = numpy.searchsorted(self.edge_check, numpy.arange(self.checks))
+        assert numpy.all(numpy.bincount(self.edge_check, minlength=self.checks) > 0)
+
+    def _syndrome(self, bits):
+        # bits is batch x N. returns batch x checks, nonzero where the check
+        # fails.
+        return numpy.add.reduceat(bits[:, self.edge_var], self.check_starts, axis=1) % 2
+
+    def _check_update(self, v2c):
+        # check node update: each edge gets the product of the signs and the
+        # minimum magnitude of the OTHER edges into the same check.
+        neg = (v2c < 0).astype(int)
+        parity = numpy.add.reduceat(neg, self.check_starts, axis=1) % 2
+        sign = 1 - 2*(parity[:, self.edge_check] ^ neg)
+
+        mag = numpy.abs(v2c)
+        min1 = numpy.minimum.reduceat(mag, self.check_starts, axis=1)
+        is_min = mag == min1[:, self.edge_check]
+        # second smallest, for the edge(s) that are the smallest themselves.
+        # if the smallest is tied, excluding one of them still leaves min1.
+        min2 = numpy.minimum.reduceat(numpy.where(is_min, numpy.inf, mag), self.check_starts, axis=1)
+        ties = numpy.add.reduceat(is_min.astype(int), self.check_starts, axis=1)
+        use_min2 = is_min & (ties[:, self.edge_check] == 1)
+        excl = numpy.where(use_min2, min2[:, self.edge_check], min1[:, self.edge_check])
+        return self.scale * sign * excl
+
+    def _var_totals(self, llr, c2v):
+        # variable node update: channel llr plus every incoming check message.
+        # one bincount over the flattened (codeword, variable) index sums the
+        # messages for the whole batch at once.
+        batch = llr.shape[0]
+        idx = (numpy.arange(batch)[:, None]*self.N + self.edge_var[None, :]).ravel()
+        sums = numpy.bincount(idx, weights=c2v.ravel(), minlength=batch*self.N)
+        return llr + sums.reshape(batch, self.N)
+
+    def decode(self, llr):
+        # llr is a vector of N channel llrs, or a batch x N array of them.
+        # positive llr means the bit is more likely a 0 (same convention as
+        # comm.LDPCDecoder). returns the posterior llrs, hard decisions,
+        # whether each codeword satisfies all parity checks and how many
+        # iterations each one took.
+        llr = numpy.asarray(llr, float)
+        single = llr.ndim == 1
+        if single:
+            llr = llr[None, :]
+        batch, N = llr.shape
+        assert N == self.N
+
+        out_llr = llr.copy()
+        bits = (llr < 0).astype(int)
+        ok = ~self._syndrome(bits).any(axis=1)
+        iterations = numpy.zeros(batch, int)
+
+        # only keep iterating on the codewords that haven't converged yet
+        # (early termination once the parity checks are satisfied).
+        active = (~ok).nonzero()[0]
+        v2c = llr[active][:, self.edge_var]
+        for it in range(1, self.iterations+1):
+            if not len(active):
+                break
+            c2v = self._check_update(v2c)
+            total = self._var_totals(llr[active], c2v)
+            v2c = total[:, self.edge_var] - c2v
+
+            out_llr[active] = total
+            bits[active] = total < 0
+            iterations[active] = it
+            done = ~self._syndrome(bits[active]).any(axis=1)
+            ok[active[done]] = True
+            active = active[~done]
+            v2c = v2c[~done]
+
+        result = {'llr': out_llr, 'bits': bits, 'ok': ok, 'iterations': iterations}
+        if single:
+            result = {k: v[0] for k, v in result.items()}
+        return result
+
+
 def run_gauss(filename):
     DEBUG = True
 
     # if we want everything to go in one block, then use len(data) as the block
     # length
     K = 8
-    epsilon = int(0.5*8)
     manager = RaptorManager(filename, K)
     block = manager.next_block()
     decoded_blocks = []
@@ -610,16 +1160,22 @@ def run_gauss(filename):
         encoder = RaptorEncoder(block)
         decoder = RaptorGaussDecoder(K)
 
-        # grab new symbols and periodically check to see if we've gathered enough
-        # to find a solution. when the decoder matrix is full rank, try and solve
-        # for the original symbols.
-        while not decoder.is_full_rank():
-            for i in range(K+epsilon):
-                e = encoder.generate_encoded()
-                decoder.add_block(e)
+        # grab new symbols and let the scheduler decide when it's worth
+        # trying to solve for the original symbols. (is_full_rank() checks the
+        # rank over the reals rather than GF(2), so just attempt the solve,
+        # which fails cleanly if the matrix isn't full rank.)
+        scheduler = RaptorDecodeScheduler(K)
+        original_block = None
+        while original_block is None:
+            e = encoder.generate_encoded()
+            decoder.add_block(e)
+            # duplicate rows are dropped, so the rows kept are len(decoder.b)
+            if scheduler.ready(decoder.blocks_received, K - len(decoder.b)):
+                print("attempting to solve after " + str(decoder.blocks_received) + " blocks.")
+                original_block = decoder.decode_gauss_base2()
+                if original_block is None:
+                    scheduler.failed(decoder.blocks_received)
 
-        print("attempting to solve after " + str(decoder.blocks_received) + " blocks.")
-        original_block = decoder.decode_gauss_base2()
         print("decoded block was...")
         print(original_block)
 
@@ -635,52 +1191,73 @@ def run_gauss(filename):
         sys.stdout.write(d.tostring())
     print("")
 
-def run_bp(filename, precode, K, c, density, oh):
+def run_bp(filename, precode, K, c, density, oh, hdpc=False, gf256=False, symb_size=1):
     DEBUG = True
 
-    manager = RaptorManager(filename, K)
+    # gf256 codes work on symbols of symb_size bytes, binary ones on bits.
+    if gf256:
+        manager = RaptorManager(filename, K, symb_size=symb_size)
+    else:
+        manager = RaptorManager(filename, K)
     if precode:
         G = manager.generate_constraint_matrix(c,density)
     else:
         G = None
+    if hdpc:
+        Gh = manager.generate_hdpc_matrix(gf256)
+    else:
+        Gh = None
 
     decoded_blocks = []
     processed_blocks = 0
+    processed_bits = 0
     source_blocks = 0
     symops = 0
     failures = 0
+    attempts = 0
     block = manager.next_block()
-    while block:
+    while block is not None:
         source_blocks += 1
         print("next block... ")
         print(block)
         # this encoder is non-systematic
-        encoder = RaptorEncoder(block, G)
-        decoder = RaptorBPDecoder(K, G, oh)
+        encoder = RaptorEncoder(block, G, symb_size=symb_size, Gh=Gh, gf256=gf256, hdpc_words=manager.get_hdpc_words())
+        decoder = RaptorBPDecoder(K, G, oh, Gh=Gh, gf256=gf256, symb_size=symb_size)
         if precode:
             # precoding happens only once per block
             intermediate = encoder.ldpc_precode()
+        if hdpc:
+            intermediate = encoder.hdpc_precode()
 
-        original_symbols = False
-        while not original_symbols:
+        original_symbols = None
+        failed = False
+        while original_symbols is None:
             e = encoder.generate_encoded()
             original_symbols = decoder.bp_decode(e)
-            if original_symbols == "failed":
+            # (symbols may be a numpy array, so check the type before comparing)
+            if isinstance(original_symbols, str) and original_symbols == "failed":
                 failures +=1
+                failed = True
                 break
 
         print(block)
         print("%d blocks processed for this block of %d source symbols." % (decoder.blocks_processed, K))
-        if not original_symbols == "failed":
+        if not failed:
             decoded_blocks.append(original_symbols)
         symops += decoder.symbol_operations
+        if decoder.scheduler is not None:
+            attempts += decoder.scheduler.attempts
         processed_blocks += decoder.blocks_processed
+        processed_bits += decoder.bits_received
         block = manager.next_block()
         print("for this round, 1 source block was processed after receiving %d encoded blocks." % decoder.blocks_processed)
 
+    # every symbol in a run has the same size (a bit, or symb_size bytes for
+    # gf256) and every block is K symbols, so received symbols per block is
+    # comparable between runs. processed_bits has the raw bits on the wire.
     overhead = (processed_blocks/float(source_blocks))
     print("%d output blocks" % source_blocks)
-    print("%d received blocks." % processed_blocks)
+    print("%d received blocks (%d bits)." % (processed_blocks, processed_bits))
     print("overhead: %d" % overhead)
 
     print("decoded blocks:")
@@ -689,16 +1266,61 @@ def run_bp(filename, precode, K, c, density, oh):
     for d in decoded_blocks:
         sys.stdout.write(d.tostring())
     print("")
-    return {'K': K, 'precode':precode, 'c':c, 'd':density,
+    return {'K': K, 'precode':precode, 'hdpc':hdpc, 'gf256':gf256, 'symb_size':symb_size, 'c':c, 'd':density,
             'source':source_blocks, 'processed': processed_blocks,
-            'overhead': overhead, 'symops': symops,
-            'K+epsilon': oh, 'failures': failures}
+            'processed_bits': processed_bits, 'overhead': overhead, 'symops': symops,
+            'K+epsilon': oh, 'failures': failures, 'attempts': attempts}
+
+
+def run_soft(filename, K, c, density, snr, hdpc=False):
+    # send the precoded (intermediate) symbols over a BPSK/AWGN channel and
+    # decode them with the soft decoder, like the QPSK/AWGN loop in test.m.
+    # all blocks of the file are decoded in one batch. snr is in dB.
+    manager = RaptorManager(filename, K)
+    G = manager.generate_constraint_matrix(c, density)
+    if hdpc:
+        Gh = manager.generate_hdpc_matrix()
+    else:
+        Gh = None
+
+    codewords = []
+    blocks = []
+    block = manager.next_block()
+    while block:
+        encoder = RaptorEncoder(block, G, Gh=Gh, hdpc_words=manager.get_hdpc_words())
+        encoder.ldpc_precode()
+        if hdpc:
+            encoder.hdpc_precode()
+        codewords.append(encoder.intermediate.tolist())
+        blocks.append(block.tolist())
+        block = manager.next_block()
+
+    codewords = numpy.array(codewords, int)
+    # bit 0 -> +1, bit 1 -> -1
+    sigma2 = 1/10**(snr/10.0)
+    rx = 1 - 2*codewords + numpy.random.normal(0, numpy.sqrt(sigma2), codewords.shape)
+    llr = 2*rx/sigma2
+
+    decoder = RaptorSoftDecoder(K, G, Gh)
+    result = decoder.decode(llr)
+    source_bits = numpy.array(blocks, int)
+    uncoded_errors = int(numpy.sum((llr[:, 0:K] < 0) != source_bits))
+    errors = int(numpy.sum(result['bits'][:, 0:K] != source_bits))
+    total_bits = source_bits.size
+    print("%d blocks, %d decoded ok, average of %.1f iterations" % (len(blocks), numpy.sum(result['ok']), numpy.mean(result['iterations'])))
+    print("uncoded bit error rate: %.4f" % (uncoded_errors/float(total_bits)))
+    print("decoded bit error rate: %.4f" % (errors/float(total_bits)))
+    return {'K': K, 'c': c, 'd': density, 'snr': snr, 'hdpc': hdpc,
+            'blocks': len(blocks), 'ok': int(numpy.sum(result['ok'])),
+            'uncoded_ber': uncoded_errors/float(total_bits),
+            'ber': errors/float(total_bits)}
 
 
 if __name__ == '__main__':
     if len(sys.argv) != 2:
         sys.stderr.write("Usage: ./raptor filename")
         sys.exit(1)
+    gf256_selfcheck()
     filename = sys.argv[1]
     start = 8
     stop = 41
@@ -713,7 +1335,8 @@ if __name__ == '__main__':
         for oh in [1.2*K, 2*K, 3*K]:
             for c in [3,5,7]:
                 for d in [0.2,0.3,0.4]:
-                    precode_results.append(run_bp(filename, precode=True, K=K, c=c, density=d, oh=int(round(oh))))
+                    for hdpc, gf256 in [(False, False), (True, False), (True, True)]:
+                        precode_results.append(run_bp(filename, precode=True, K=K, c=c, density=d, oh=int(round(oh)), hdpc=hdpc, gf256=gf256))
 
     print("Non precoded results")
     print("K\tOverhead\tSymops\tFail")
@@ -722,9 +1345,9 @@ if __name__ == '__main__':
     print("\n")
 
     print("Precoded results")
-    print("K\tc\td\t\tOverhead\tSymops\tFail\tK+epsilon")
+    print("K\tc\td\t\tHDPC\tGF256\tOverhead\tSymops\tFail\tK+epsilon\tAttempts")
     for r in precode_results:
-        print("%d\t%d\t%.3f\t\t%.3f\t\t%d\t%d\t%d" % (r['K'], r['c'], r['d'], r['overhead'], r['symops'], r['failures'], r['K+epsilon']))
+        print("%d\t%d\t%.3f\t\t%d\t%d\t%.3f\t\t%d\t%d\t%d\t\t%d" % (r['K'], r['c'], r['d'], r['hdpc'], r['gf256'], r['overhead'], r['symops'], r['failures'], r['K+epsilon'], r['attempts']))
     print("\n")
 
 